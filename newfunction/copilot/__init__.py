@@ -14,7 +14,24 @@ from functools import lru_cache
 import aiohttp
 import asyncio
 import requests
+import threading
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 from .countermanager import TableStorageManager
+from .burstmanager import BurstManager
+from .visionmanager import extract_vision_result
+from .exportmanager import export_counters
+from .resetmanager import reset_quotas, QUOTA_RESET_ENABLED
+from .jobstate import JOB_STATE_TABLE
+from .dispatchmanager import VonageDispatcher, DeliveryUnknownError, RETRYABLE_STATUS_CODES
+from .models import InboundMessage, InvalidPayloadError, loads, dumps, classify_webhook, WEBHOOK_STATUS, WEBHOOK_OTHER
+from .statusmanager import StatusRecorder
+from .flightmanager import SingleFlight, normalize_question
+from .profilemanager import maybe_profile, should_profile, profile_call
+from .outboxmanager import Outbox, STATUS_SENT, STATUS_PENDING, STATUS_DEAD, STATUS_UNKNOWN
+from .usagemanager import UsageTracker, estimate_tokens
+from .templatemanager import render_template
+from .shadowmanager import ShadowTraffic
 
 
  
@@ -23,21 +40,34 @@ logger = logging.getLogger(__name__)
 
 # Initialize the TableStorageManager
 connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+usage_table_manager = None
+job_state_manager = None
 try:
     table_manager = TableStorageManager(connection_string, "MessageCounter")
+    usage_table_manager = TableStorageManager(connection_string, "UsageCounter")
+    job_state_manager = TableStorageManager(connection_string, JOB_STATE_TABLE)
     logger.info("Connected to Azure Table Storage successfully.")
 except Exception as e:
     logger.error("Failed to initialize Table Storage: ", exc_info=True)
 
 
 MESSAGE_THRESHOLD = 55 
+
+# Per-user Flowise and Azure AI usage, written to the UsageCounter table in batches
+usage_tracker = UsageTracker(usage_table_manager, flush_interval=float(os.getenv('USAGE_FLUSH_INTERVAL', '60')))
  
 # Vonage and Flowise configuration
 
 VONAGE_MESSAGES_API_URL = "https://api.nexmo.com/v1/messages"
 VONAGE_APPLICATION_ID = os.getenv('VONAGE_APPLICATION_ID')
+VONAGE_SANDBOX_NUMBER = "254769132469"  # Replace with your Vonage number
 
 FLOWISE_API_URL = os.getenv('FLOWISE_API_URL')
+# Candidate chatflow that gets a sampled, fire-and-forget copy of query_flowise traffic
+FLOWISE_SHADOW_URL = os.getenv('FLOWISE_SHADOW_URL')
+FLOWISE_SHADOW_SAMPLE_RATE = float(os.getenv('FLOWISE_SHADOW_SAMPLE_RATE', '0'))
+flowise_shadow = ShadowTraffic(FLOWISE_SHADOW_URL, FLOWISE_SHADOW_SAMPLE_RATE,
+                               report_every=int(os.getenv('FLOWISE_SHADOW_REPORT_EVERY', '50')))
  
 # Path to private key file
 PRIVATE_KEY_FILE_PATH = '/home/site/wwwroot/copilot/private.pem'
@@ -51,8 +81,10 @@ def load_private_key_from_file(file_path):
         private_key = pem_file.read()
     return private_key
 
-# Vonage client initialization
-VONAGE_PRIVATE_KEY = load_private_key_from_file(PRIVATE_KEY_FILE_PATH)
+# Vonage client initialization, loaded on first send so tools importing this package need no key
+@lru_cache(maxsize=1)
+def get_vonage_private_key():
+    return load_private_key_from_file(PRIVATE_KEY_FILE_PATH)
 
 
 
@@ -61,6 +93,7 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 # Set up Azure AI configuration
 AZURE_AI_ENDPOINT = os.getenv('AZURE_AI_ENDPOINT')
 AZURE_AI_KEY = os.getenv('AZURE_AI_KEY')
+VISION_TOKEN_BUDGET = int(os.getenv('VISION_TOKEN_BUDGET', '250'))
 
 async def async_post_with_aiohttp(url, json_payload, headers):
     async with aiohttp.ClientSession() as session:
@@ -69,18 +102,34 @@ async def async_post_with_aiohttp(url, json_payload, headers):
             return await response.json()
 
 
-async def process_image_with_azure_ai(image_url):
+async def download_image(session, image_url):
+    async with session.get(image_url) as image_response:
+        image_response.raise_for_status()
+        return await image_response.read()
+
+
+async def process_image_with_azure_ai(image_url, sender_phone_number=None):
+    return await process_images_with_azure_ai([image_url], sender_phone_number)
+
+
+async def process_images_with_azure_ai(image_urls, sender_phone_number=None):
     # Log the image processing step for debugging
-    logger.info(f"Processing image with Azure AI: {image_url}")
+    logger.info(f"Processing {len(image_urls)} image(s) with Azure AI: {image_urls}")
     
-    # Download the image from the provided URL
+    # Download all the images of the burst concurrently
     async with aiohttp.ClientSession() as session:
-        async with session.get(image_url) as image_response:
-            image_response.raise_for_status()
-            image_content = await image_response.read()
-
-    # Encode the image in base64
-    encoded_image = base64.b64encode(image_content).decode('ascii')
+        image_contents = await asyncio.gather(*(download_image(session, url) for url in image_urls))
+
+    # Batch every image into a single request, encoded in base64
+    image_parts = [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64.b64encode(image_content).decode('ascii')}"
+            }
+        }
+        for image_content in image_contents
+    ]
     
     # Set up headers with API key
     headers = {
@@ -97,14 +146,7 @@ async def process_image_with_azure_ai(image_url):
             },
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{encoded_image}"
-                        }
-                    }
-                ]
+                "content": image_parts
             }
             # You can extend the messages list if you need other interactions
         ],
@@ -114,46 +156,55 @@ async def process_image_with_azure_ai(image_url):
     }
     
     # Send POST request to the Azure endpoint and return the analyzed result
+    started = time.perf_counter()
     try:
         ai_response_data = await async_post_with_aiohttp(AZURE_AI_ENDPOINT, payload, headers)
         logger.info(f"Azure AI response: {ai_response_data}")
-        return ai_response_data
+        usage = ai_response_data.get('usage') or {}
+        usage_tracker.record(sender_phone_number, 'vision', started,
+                             usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        # Only the assistant text, trimmed to budget, is worth forwarding to Flowise
+        return extract_vision_result(ai_response_data, VISION_TOKEN_BUDGET)
     except Exception as e:
         logger.error(f"Error processing image with Azure AI: {e}")
+        usage_tracker.record(sender_phone_number, 'vision', started, error=True)
         return None
 
 
-def get_image_url_from_data(data):
-   
-    # Extract the 'image' dictionary from the data and then the 'url' from the 'image' dictionary
-    image_info = data['image']
-    if image_info and 'url' in image_info:
-        return image_info['url']
-    else:
-        # Log an error if the URL is not found and return None
-        logger.error("No image URL found in the inbound data.")
-        return None
-    
- 
- 
 async def main(req: func.HttpRequest) -> func.HttpResponse:
+    # Parse the body once into a typed message
+    try:
+        request_body = loads(req.get_body())
+    except ValueError:
+        return func.HttpResponse("Invalid JSON", status_code=400)
+
+    # Status callbacks and other webhooks skip the conversation pipeline entirely
+    webhook_kind = classify_webhook(request_body)
+    if webhook_kind == WEBHOOK_STATUS:
+        status_recorder.record(request_body)
+        # Settles replies whose delivery was in doubt, matched on the client_ref we sent
+        if request_body.get('client_ref') and request_body.get('status') in DELIVERED_STATUSES:
+            await asyncio.to_thread(profile_call, reply_outbox.confirm, request_body['client_ref'])
+        return func.HttpResponse(status_code=200)
+    if webhook_kind == WEBHOOK_OTHER:
+        return func.HttpResponse("No action needed for no-type message", status_code=200)
+
     logger.info('Python HTTP trigger function processed a request.')
  
     # Log the headers and body of the incoming request for debugging
     logger.info(f"Request headers: {req.headers}")
-    
- 
-    # Check if the request has JSON content
-    try:
-        request_body = req.get_json()  # Directly get JSON content
-    except ValueError:
-        return func.HttpResponse("Invalid JSON", status_code=400)
-    
     logger.info(f"Request body: {request_body}")
+
+    try:
+        message = InboundMessage.from_dict(request_body)
+    except InvalidPayloadError as e:
+        logger.error(f"Invalid inbound payload: {e}")
+        return func.HttpResponse(str(e), status_code=400)
  
     # Handle the '/vonage-inbound' path
     if req.method == 'POST':
-        response = await handle_vonage_inbound(request_body)  # Use await here
+        with maybe_profile('handle_vonage_inbound', should_profile(req.headers)):
+            response = await handle_vonage_inbound(message)  # Use await here
         return response
  
     # If the request method is not POST, return a not found response
@@ -162,19 +213,34 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
     
 # Initialization outside function to ensure it persists across invocations
 processed_message_uuids = set()
+DELIVERED_STATUSES = ('submitted', 'delivered', 'read')
+status_recorder = StatusRecorder(
+    flush_interval=float(os.getenv('STATUS_FLUSH_INTERVAL', '60')),
+    flush_size=int(os.getenv('STATUS_FLUSH_SIZE', '500')),
+)
+
+# Messages a sender fires off within this many seconds are answered together
+BURST_COALESCE_WINDOW = float(os.getenv('BURST_COALESCE_WINDOW', '2'))
+BURST_COALESCE_MAX_WAIT = float(os.getenv('BURST_COALESCE_MAX_WAIT', '6'))
+burst_manager = BurstManager(BURST_COALESCE_WINDOW, BURST_COALESCE_MAX_WAIT)
+
+# Identical questions from the same chat share one Flowise call and one reply while it is in flight,
+# or when they arrive within this many seconds of the first one
+FLOWISE_DUPLICATE_WINDOW = float(os.getenv('FLOWISE_DUPLICATE_WINDOW', '5'))
+flowise_flight = SingleFlight(FLOWISE_DUPLICATE_WINDOW)
 
 
  
 
 
         # Define the handler for vonage-inbound
-async def handle_vonage_inbound(data):
+async def handle_vonage_inbound(message: InboundMessage):
     
-    logger.info(f"Incoming data: {data}")
+    logger.info(f"Incoming message: {message}")
 
     try:
-        message_uuid = data.get('message_uuid')
-        sender_phone_number = data.get('from')
+        message_uuid = message.message_uuid
+        sender_phone_number = message.sender
 
         if message_uuid in processed_message_uuids:
             logger.info("Duplicate message received, skipping processing.")
@@ -183,54 +249,30 @@ async def handle_vonage_inbound(data):
         processed_message_uuids.add(message_uuid)
 
 
-        message_type = data.get('message_type')
-        if message_type is None:
-            logger.info("Received message with no type, possibly from Flowise.")
-            return func.HttpResponse("No action needed for no-type message", status_code=200)
-    
+        message_type = message.message_type
+
+        # Start reading the sender's quota now so it is ready by the time we reply.
+        # Messages joining an open burst are answered by its first message instead.
+        quota_prefetch = None
+        if sender_phone_number not in burst_manager.bursts:
+            quota_prefetch = asyncio.create_task(fetch_quota_state(sender_phone_number))
+
         if message_type == 'image':
-            image_url = get_image_url_from_data(data)
-            if image_url:
-                notify_msg = "I received an image and am analyzing it. Please wait..."
-                notify_response = await notify_flowise_image_processing(notify_msg, sender_phone_number)
-
-                image_description = await process_image_with_azure_ai(image_url)
-                if image_description:
-                    analysis_description = f"Here is the description: {image_description}"
-                    flowise_response_message = await notify_flowise_image_processing(
-                        "I have finished analyzing the image.", sender_phone_number, analysis_description)
-                    if flowise_response_message:
-                        send_whatsapp_message(sender_phone_number, flowise_response_message)
-                    else:
-                        logger.error("Failed to get valid response from Flowise.")
-                else:
-                    logger.error("Failed to get image description from Azure AI.")
-            else:
-                logger.error("No image URL found in the data.")
+            burst = await burst_manager.collect(
+                sender_phone_number, text=message.image.caption, image_url=message.image.url)
 
         elif message_type == 'text':
-            incoming_msg = data.get('text', '')
-            # Check if the message threshold is reached
-
-
-            # If threshold not reached, handle the text message and update the count
-            flowise_response = await query_flowise(incoming_msg, sender_phone_number)
-            if isinstance(flowise_response, str): 
-# Here is where you should log and send the message
-                logger.info(f"Sending Flowise response to WhatsApp: {flowise_response}")
-                send_whatsapp_message(sender_phone_number, flowise_response)
-                return func.HttpResponse(
-                    json.dumps({"status": "success", "response_from_flowise": flowise_response}),
-                    status_code=200,
-                    mimetype="application/json"
-                )
-            else:
-                logger.error("Failed to process text message.")
-
+            burst = await burst_manager.collect(sender_phone_number, text=message.text)
 
         else:
             logger.error(f"Unhandled message type: {message_type}")
             return func.HttpResponse("Message type not supported.", status_code=400)
+
+        # Only the first message of a burst answers; the rest were merged into it
+        if burst is None:
+            return func.HttpResponse("Message merged into burst", status_code=200)
+
+        return await process_burst(sender_phone_number, burst, quota_prefetch)
    
       
     except Exception as e:
@@ -241,6 +283,77 @@ async def handle_vonage_inbound(data):
     return func.HttpResponse("Message processed successfully", status_code=200)
 
 
+async def fetch_quota_state(number):
+    try:
+        return await asyncio.to_thread(profile_call, table_manager.get_quota_state, number)
+    except Exception as e:
+        logger.error(f"Failed to prefetch quota state for {number}: {e}")
+        return None
+
+
+async def process_burst(sender_phone_number, burst, quota_prefetch=None):
+    # Decide admission before spending any LLM or vision capacity on the reply
+    quota_state = await quota_prefetch if quota_prefetch else await fetch_quota_state(sender_phone_number)
+    if quota_state and is_over_quota(sender_phone_number, quota_state):
+        logger.info(f"{sender_phone_number} is over quota, skipping the AI call.")
+        if not quota_state.notification_sent:
+            await run_vonage_call(handle_over_quota, sender_phone_number)
+        return func.HttpResponse("Message limit reached", status_code=200)
+
+    question = "\n".join(burst.texts)
+
+    if burst.image_urls:
+        # Acknowledge from a local template while the analysis runs, no LLM round trip needed
+        image_count = len(burst.image_urls)
+        ack_msg = render_template('image_received' if image_count == 1 else 'images_received', count=image_count)
+        # A failed acknowledgement must not throw away a finished analysis, and vice versa
+        ack_result, vision_result = await asyncio.gather(
+            run_vonage_call(send_whatsapp_notice, sender_phone_number, ack_msg),
+            process_images_with_azure_ai(burst.image_urls, sender_phone_number),
+            return_exceptions=True)
+        if isinstance(ack_result, Exception):
+            logger.error(f"Failed to acknowledge images from {sender_phone_number}: {ack_result}")
+        if isinstance(vision_result, Exception):
+            logger.error(f"Failed to analyze images from {sender_phone_number}: {vision_result}")
+            vision_result = None
+        if vision_result:
+            analysis_description = f"Here is the description: {vision_result.text}"
+            if question:
+                analysis_description += f"\nThe student also wrote: {question}"
+            flowise_response_message = await notify_flowise_image_processing(
+                "I have finished analyzing the image.", sender_phone_number, analysis_description)
+            if flowise_response_message:
+                # The dispatcher paces and backs off with blocking sleeps, keep it off the event loop
+                await run_vonage_call(send_whatsapp_message, sender_phone_number, flowise_response_message, quota_state)
+            else:
+                logger.error("Failed to get valid response from Flowise.")
+            return func.HttpResponse("Message processed successfully", status_code=200)
+
+        # Still answer whatever the student wrote alongside the images
+        logger.error("Failed to get image description from Azure AI.")
+
+    if question:
+        # Answer the whole burst with a single Flowise question, shared with any duplicate in flight
+        flowise_response, is_leader = await flowise_flight.do(
+            (sender_phone_number, normalize_question(question)),
+            lambda: query_flowise(question, sender_phone_number))
+        if not is_leader:
+            logger.info(f"Duplicate question from {sender_phone_number}, not replying again.")
+            return func.HttpResponse("Duplicate message suppressed", status_code=200)
+        if isinstance(flowise_response, str): 
+            logger.info(f"Sending Flowise response to WhatsApp: {flowise_response}")
+            await run_vonage_call(send_whatsapp_message, sender_phone_number, flowise_response, quota_state)
+            return func.HttpResponse(
+                dumps({"status": "success", "response_from_flowise": flowise_response}),
+                status_code=200,
+                mimetype="application/json"
+            )
+        else:
+            logger.error("Failed to process text message.")
+
+    return func.HttpResponse("Message processed successfully", status_code=200)
+
+
 async def notify_flowise_image_processing(notification_message, sender_phone_number, image_analysis=None):
     payload = {"chatId": sender_phone_number}
     if image_analysis:
@@ -250,16 +363,22 @@ async def notify_flowise_image_processing(notification_message, sender_phone_num
 
     headers = {"Content-Type": "application/json"}
 
+    started = time.perf_counter()
+    answer = None
     async with aiohttp.ClientSession() as session:
         try:
             async with session.post(FLOWISE_API_URL, json=payload, headers=headers) as response:
                 response.raise_for_status()
                 response_data = await response.json()
                 logger.info(f"Flowise response: {response_data}")
-                return response_data.get("text", "")
+                answer = response_data.get("text", "")
+                return answer
         except aiohttp.ClientError as e:
             logger.error(f"Error notifying Flowise: {e}")
             return None
+        finally:
+            usage_tracker.record(sender_phone_number, 'flowise', started, estimate_tokens(payload["question"]),
+                                 estimate_tokens(answer), error=answer is None)
 
     
 
@@ -308,7 +427,130 @@ def check_mpesa_stkpush_status(invoice_id):
 
 
 
+# M-Pesa invoices waiting for a payment callback: invoice_id -> (phone number, created at)
+pending_invoices = {}
+pending_invoices_lock = threading.Lock()
+
+PAYMENT_FINAL_STATES = ('COMPLETE', 'FAILED', 'RETRY')
+PAYMENT_INITIATING = 'INITIATING'
+PENDING_INVOICE_TTL = 3600
+
+# While a number has a pending invoice younger than this, later messages reuse it instead of a new STK push
+PAYMENT_SESSION_TTL = int(os.getenv('PAYMENT_SESSION_TTL', '180'))
+# Numbers with an STK push being initiated on this worker right now
+payment_initiations = set()
+
+# Shared secret the payment provider echoes back in every callback
+MPESA_CALLBACK_CHALLENGE = os.getenv('MPESA_CALLBACK_CHALLENGE')
+
+# Polling is only a slow fallback for callbacks that never arrive
+MPESA_FALLBACK_POLL_DELAY = int(os.getenv('MPESA_FALLBACK_POLL_DELAY', '60'))
+MPESA_FALLBACK_POLL_INTERVAL = int(os.getenv('MPESA_FALLBACK_POLL_INTERVAL', '30'))
+MPESA_FALLBACK_POLL_TRIES = int(os.getenv('MPESA_FALLBACK_POLL_TRIES', '3'))
+
+
+def fetch_invoice(invoice_id):
+    payment_status_response = check_mpesa_stkpush_status(invoice_id)
+    if payment_status_response and isinstance(payment_status_response.get('invoice'), dict):
+        return payment_status_response['invoice']
+    return None
+
+
+def settle_invoice(invoice_id, state, number=None):
+    # Claim the invoice so the callback and the fallback poll never both act on it
+    with pending_invoices_lock:
+        pending = pending_invoices.pop(invoice_id, None)
+
+    if pending:
+        number = pending[0]
+    elif number:
+        logger.info(f"Invoice {invoice_id} is not pending on this worker, using callback account {number}.")
+    else:
+        logger.info(f"Invoice {invoice_id} is not pending, ignoring {state} update.")
+        return None
+
+    if state == 'COMPLETE':
+        # The reset and the record of this invoice are one conditional write, so a COMPLETE
+        # for any invoice issued to this number is applied exactly once, however often
+        # the callback and the fallback poll report it
+        logger.info(f"Payment complete for {number}, resetting message count.")
+        applied = table_manager.complete_payment(number, invoice_id)
+        if applied is None:
+            logger.error("Failed to reset message count.")
+            return False
+        if not applied:
+            logger.info(f"Payment for invoice {invoice_id} was already applied for {number}.")
+            return True
+        # Payment notices skip the quota check and the outbox, and never use up a paid message
+        send_whatsapp_notice(number, "Payment completed. You can resume the conversation.")
+        table_manager.set_notification_sent(number, sent=False)
+        logger.info("Confirmation message sent.")
+        return True
+
+    # The session tells us whether this failure was already announced or a newer push replaced it
+    session = table_manager.get_payment_session(number)
+    current = session is not None and session.invoice_id == invoice_id and session.state != PAYMENT_INITIATING
+    announced = current and session.state in (state, 'COMPLETE')
+
+    if announced or (session is not None and not current):
+        logger.info(f"Not announcing {state} for invoice {invoice_id}, already announced or superseded by a newer push.")
+        return True
+    table_manager.set_payment_session(number, invoice_id, state)
+    if not table_manager.is_notification_sent(number):
+        send_whatsapp_notice(number, "Payment failed. Try sending another message to retry the payment.")
+        table_manager.set_notification_sent(number, sent=True)
+    return True
+
+
+def poll_invoice_fallback(invoice_id, number):
+    for attempt in range(MPESA_FALLBACK_POLL_TRIES):
+        with pending_invoices_lock:
+            if invoice_id not in pending_invoices:
+                logger.info(f"Invoice {invoice_id} already settled by callback, stopping fallback poll.")
+                return
+        session = table_manager.get_payment_session(number)
+        if session and session.invoice_id == invoice_id and session.state in PAYMENT_FINAL_STATES:
+            logger.info(f"Invoice {invoice_id} already settled on another worker, stopping fallback poll.")
+            with pending_invoices_lock:
+                pending_invoices.pop(invoice_id, None)
+            return
+
+        state = (fetch_invoice(invoice_id) or {}).get('state')
+
+        if state in PAYMENT_FINAL_STATES:
+            logger.info(f"Payment callback missing for invoice {invoice_id}, settling from fallback poll.")
+            settle_invoice(invoice_id, state)
+            return
+
+        if attempt < MPESA_FALLBACK_POLL_TRIES - 1:
+            time.sleep(MPESA_FALLBACK_POLL_INTERVAL)
+
+    # Leave the invoice pending so a late callback can still settle it
+    logger.info("Exceeded maximum number of tries for payment status checks.")
+    send_whatsapp_notice(number, "Your payment attempt is taking longer than usual. Please check your Mpesa messages.")
+    table_manager.set_notification_sent(number, sent=True)
+
+
 def handle_threshold_exceeded(number):
+    # Single flight per number: one STK push at a time, reused while its invoice is pending
+    with pending_invoices_lock:
+        if number in payment_initiations:
+            logger.info(f"STK Push for {number} is already being initiated, not sending another.")
+            return 'Payment request already sent. Please complete the payment on your phone.'
+        payment_initiations.add(number)
+
+    try:
+        # Conditional write on the stored session, so only one worker ever pushes at a time
+        if not table_manager.claim_payment_session(number, PAYMENT_SESSION_TTL):
+            logger.info(f"A payment for {number} is already being initiated or pending, not sending another STK Push.")
+            return 'Payment request already sent. Please complete the payment on your phone.'
+        return initiate_payment(number)
+    finally:
+        with pending_invoices_lock:
+            payment_initiations.discard(number)
+
+
+def initiate_payment(number):
     logger.info(f"Threshold reached for {number}. Triggering Mpesa STK Push.")
 
     # Call STK Push API
@@ -316,53 +558,99 @@ def handle_threshold_exceeded(number):
 
     if mpesa_response and 'invoice' in mpesa_response and 'invoice_id' in mpesa_response['invoice']:
         invoice_id = mpesa_response['invoice']['invoice_id']
-        max_tries = 3
-        count = 0
-
-        # Initial delay before first status check
-        time.sleep(15)
-
-        while count < max_tries:
-            payment_status_response = check_mpesa_stkpush_status(invoice_id)
-            state = payment_status_response['invoice']['state']
-
-            if state == 'COMPLETE':
-                logger.info(f"Payment complete for {number}, resetting message count.")
-                if table_manager.reset_message_count(number):
-                    send_whatsapp_message(number, "Payment completed. You can resume the conversation.")
-                    table_manager.set_notification_sent(number, sent=False)
-                    logger.info("Confirmation message sent.")
-                    return 'Payment completed. You can resume conversation.'
-                else:
-                    logger.error("Failed to reset message count.")
-                    break
-
-            elif state == 'RETRY' or state == 'FAILED':
-                if not table_manager.is_notification_sent(number):
-                    send_whatsapp_message(number, "Payment failed. Try sending another message to retry the payment.")
-                    table_manager.set_notification_sent(number, sent=True)
-                return 'Your payment failed. Please try sending another message to retry the payment.'
-
-            elif state == 'PENDING':
-                count += 1
-                if count < max_tries:
-                    time.sleep(5)  # Pause for next check
-            else:
-                logger.info("Unhandled payment state.")
-        
-        if count == max_tries:
-            logger.info("Exceeded maximum number of tries for payment status checks.")
-            send_whatsapp_message(number, "Your payment attempt is taking longer than usual. Please check your Mpesa messages.")
-            table_manager.set_notification_sent(number, sent=True)
-        return 'Your payment attempt is taking longer than usual. Please check your Mpesa messages.'
+        table_manager.set_payment_session(number, invoice_id, 'PENDING')
+        now = time.time()
+        with pending_invoices_lock:
+            for stale_id in [i for i, (_, created) in pending_invoices.items() if now - created > PENDING_INVOICE_TTL]:
+                del pending_invoices[stale_id]
+            pending_invoices[invoice_id] = (number, now)
+
+        # The payment callback settles the invoice; only poll if it never shows up
+        fallback = threading.Timer(MPESA_FALLBACK_POLL_DELAY, poll_invoice_fallback, [invoice_id, number])
+        fallback.daemon = True
+        fallback.start()
+        return 'Payment request sent. Please complete the payment on your phone.'
     else:
         logger.error("Failed to initiate payment.")
+        table_manager.release_payment_session(number)
         return 'Failed to initiate payment. Please try again.'
-    
 
 
+async def mpesa_callback(req: func.HttpRequest) -> func.HttpResponse:
+    logger.info('M-Pesa payment callback received.')
+
+    try:
+        callback_body = req.get_json()
+    except ValueError:
+        return func.HttpResponse("Invalid JSON", status_code=400)
+
+    if not isinstance(callback_body, dict):
+        return func.HttpResponse("Invalid JSON", status_code=400)
+
+    logger.info(f"Payment callback body: {callback_body}")
+
+    # The route is anonymous, so the shared secret is the only thing standing between
+    # a forged COMPLETE and a free quota reset
+    if not MPESA_CALLBACK_CHALLENGE:
+        logger.error("MPESA_CALLBACK_CHALLENGE is not configured, rejecting payment callback.")
+        return func.HttpResponse(status_code=403)
+    if not hmac.compare_digest(str(callback_body.get('challenge', '')), MPESA_CALLBACK_CHALLENGE):
+        logger.error("Payment callback challenge mismatch, ignoring callback.")
+        return func.HttpResponse(status_code=403)
+
+    invoice_id = callback_body.get('invoice_id')
+    state = callback_body.get('state')
+    if not invoice_id or not state:
+        return func.HttpResponse("Missing invoice_id or state", status_code=400)
+
+    if state in PAYMENT_FINAL_STATES:
+        number = callback_body.get('account')
+        with pending_invoices_lock:
+            issued_here = invoice_id in pending_invoices
+
+        # An invoice this worker did not issue is only trusted once the provider confirms its state
+        if not issued_here:
+            invoice = await asyncio.to_thread(profile_call, fetch_invoice, invoice_id)
+            if invoice is None:
+                logger.error(f"Could not verify invoice {invoice_id} with the payment provider.")
+                return func.HttpResponse("Could not verify invoice", status_code=503)
+            if invoice.get('state') != state:
+                logger.error(f"Callback state {state} for invoice {invoice_id} does not match provider state {invoice.get('state')}.")
+                return func.HttpResponse("Invoice state mismatch", status_code=409)
+            number = invoice.get('account') or number
+
+        # Settling talks to Table Storage and Vonage synchronously, keep it off the event loop
+        settled = await run_vonage_call(settle_invoice, invoice_id, state, number)
+        if settled is False:
+            # A 5xx makes the provider retry the callback
+            return func.HttpResponse("Failed to settle invoice", status_code=500)
+    else:
+        logger.info(f"Invoice {invoice_id} is {state}, waiting for a final state.")
+
+    return func.HttpResponse("Callback processed", status_code=200)
+
+
+ 
+ 
+def export_counters_timer(timer: func.TimerRequest) -> None:
+    if timer.past_due:
+        logger.info("Counter export timer is past due.")
+    try:
+        export_counters(table_manager, job_state_manager)
+    except Exception as e:
+        logger.error(f"Counter export failed: {e}", exc_info=True)
+
+
+def reset_quotas_timer(timer: func.TimerRequest) -> None:
+    if not QUOTA_RESET_ENABLED:
+        logger.info("Periodic quota reset is disabled, set QUOTA_RESET_ENABLED=true to enable it.")
+        return
+    try:
+        reset_quotas(table_manager, job_state_manager)
+    except Exception as e:
+        logger.error(f"Quota reset failed: {e}", exc_info=True)
+
 
-    
  
  
 # Vonage client initialization
@@ -376,81 +664,161 @@ def generate_jwt(application_id, private_key):
     token = jwt.encode(payload, private_key, algorithm='RS256')
     return token
 
-def send_whatsapp_message(to_number, text_message):
+# All outbound messages share one dispatcher so the Vonage rate limits hold across requests
+vonage_dispatcher = VonageDispatcher(
+    VONAGE_MESSAGES_API_URL,
+    lambda: generate_jwt(VONAGE_APPLICATION_ID, get_vonage_private_key()),
+    global_rate=float(os.getenv('VONAGE_GLOBAL_RATE', '20')),
+    per_number_rate=float(os.getenv('VONAGE_PER_NUMBER_RATE', '1')),
+    per_number_burst=int(os.getenv('VONAGE_PER_NUMBER_BURST', '5')),
+    max_retries=int(os.getenv('VONAGE_MAX_RETRIES', '4')),
+)
+
+# Sends can block for minutes under throttling, so they get their own threads instead of
+# starving the default executor that quota reads and outbox confirmations run on
+vonage_executor = ThreadPoolExecutor(max_workers=int(os.getenv('VONAGE_SEND_WORKERS', '8')),
+                                     thread_name_prefix='vonage-send')
+
+
+async def run_vonage_call(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(vonage_executor, profile_call, function, *args)
+
+
+def message_threshold_for(number):
     WHITELIST = set(os.getenv('WHITELIST', '').split(','))
+    return MESSAGE_THRESHOLD if number in WHITELIST else 7
 
-    vonage_sandbox_number = "254769132469"  # Replace with your Vonage number
-    token = generate_jwt(VONAGE_APPLICATION_ID, VONAGE_PRIVATE_KEY)
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {token}',
+
+def is_over_quota(number, quota_state):
+    return quota_state.message_count >= message_threshold_for(number)
+
+
+def handle_over_quota(to_number):
+    WHITELIST = set(os.getenv('WHITELIST', '').split(','))
+    message_threshold = message_threshold_for(to_number)
+
+    if to_number in WHITELIST:
+        # Custom message for whitelisted users when they reach 5 messages
+        notification_msg = ("Hello! 👋\n"
+                            "Thank you for participating in our trial. You have reached 50 messages. "
+                            "Please contact 254706601809 for your reward before you continue. "
+                            "This will allow us to go through the conversation for analysis. "
+                            "Share this message as proof. Thank you for your support!")
+    else:
+        # Standard message for non-whitelisted users when they reach 7 messages
+        notification_msg = ("Hello! 👋\n"
+                            "Thanks for using gTahidi! You've reached your free message limit of "
+                            f"{message_threshold} messages. To keep enjoying our services, please "
+                            "complete a small payment of 20 shillings via M-Pesa.\n"
+                            "Ensure your WhatsApp number is linked to your M-Pesa account. Need help? "
+                            "Call our support team at +254726278575.\n"
+                            "Thank you for your support!")
+
+    payload = {
+        "from": VONAGE_SANDBOX_NUMBER,
+        "to": to_number,
+        "message_type": "text",
+        "text": notification_msg,
+        "channel": "whatsapp"
     }
 
-    # Fetch the current message count from Azure Table Storage
-    count = table_manager.get_message_count(to_number)
-    message_threshold = MESSAGE_THRESHOLD if to_number in WHITELIST else 7
+    logger.info(f"Vonage payload: {payload}")
+
+    # Send the threshold notification message via Vonage
+    try:
+        response = vonage_dispatcher.send(payload)
+    except DeliveryUnknownError:
+        response = None
+    if response is None or response.status_code != 202:
+        table_manager.set_notification_sent(to_number, sent=True)
+        logger.error(f"Failed to send threshold notification to {to_number}, Status Code: {getattr(response, 'status_code', None)}, Response Body: {getattr(response, 'text', None)}")
+
+    # Log that the threshold message was sent
+    logger.info(f"Threshold notification sent to {to_number}. Message: {notification_msg}")
+
+    table_manager.set_notification_sent(to_number, sent=True)
+
+    # Do not proceed with further message sending since the threshold message has been sent
+    return handle_threshold_exceeded(to_number)
 
-    if count >= message_threshold:
-        if not table_manager.is_notification_sent(to_number):  # Check if notification has already been sent
-        
-            if to_number in WHITELIST:
-                # Custom message for whitelisted users when they reach 5 messages
-                notification_msg = ("Hello! 👋\n"
-                                    "Thank you for participating in our trial. You have reached 50 messages. "
-                                    "Please contact 254706601809 for your reward before you continue. "
-                                    "This will allow us to go through the conversation for analysis. "
-                                    "Share this message as proof. Thank you for your support!")
-            else:
-                # Standard message for non-whitelisted users when they reach 7 messages
-                notification_msg = ("Hello! 👋\n"
-                                    "Thanks for using gTahidi! You've reached your free message limit of "
-                                    f"{message_threshold} messages. To keep enjoying our services, please "
-                                    "complete a small payment of 20 shillings via M-Pesa.\n"
-                                    "Ensure your WhatsApp number is linked to your M-Pesa account. Need help? "
-                                    "Call our support team at +254726278575.\n"
-                                    "Thank you for your support!")
-
-            payload = {
-                "from": vonage_sandbox_number,
-                "to": to_number,
-                "message_type": "text",
-                "text": notification_msg,
-                "channel": "whatsapp"
-            }
 
-            logger.info(f"Vonage payload: {payload}")
-            
-            # Send the threshold notification message via Vonage
-            response = requests.post(VONAGE_MESSAGES_API_URL, headers=headers, json=payload)
-            if response.status_code != 202:
-                table_manager.set_notification_sent(to_number, sent=True)
-                logger.error(f"Failed to send threshold notification to {to_number}, Status Code: {response.status_code}, Response Body: {response.text}")
-            
-            # Log that the threshold message was sent
-            logger.info(f"Threshold notification sent to {to_number}. Message: {notification_msg}")
+def send_whatsapp_message(to_number, text_message, quota_state=None):
+    # Fetch the quota state from Azure Table Storage, unless the handler prefetched it.
+    # It only decides admission; the count is incremented against the stored value below.
+    if quota_state is None:
+        quota_state = table_manager.get_quota_state(to_number)
 
-            table_manager.set_notification_sent(to_number, sent=True)
+    if is_over_quota(to_number, quota_state):
+        if not quota_state.notification_sent:  # Check if notification has already been sent
+            return handle_over_quota(to_number)
 
-            # Do not proceed with further message sending since the threshold message has been sent
-            return handle_threshold_exceeded(to_number)
+    # If threshold not reached, proceed to send the message through the outbox,
+    # so a reply we already paid for is replayed later if Vonage is unavailable now
+    if reply_outbox.send(to_number, text_message):
+        table_manager.increment_message_count(to_number)
 
-    # If threshold not reached, proceed to send the message
+
+def send_whatsapp_notice(to_number, text_message):
+    # Service notices skip the outbox and do not count towards the message limit
     payload = {
-        "from": vonage_sandbox_number,
+        "from": VONAGE_SANDBOX_NUMBER,
         "to": to_number,
         "message_type": "text",
         "text": text_message,
         "channel": "whatsapp"
     }
+
+    try:
+        response = vonage_dispatcher.send(payload)
+    except DeliveryUnknownError:
+        return False
+    if response is None or response.status_code != 202:
+        logger.error(f"Failed to send notice to {to_number}, Status Code: {getattr(response, 'status_code', None)}, Response Body: {getattr(response, 'text', None)}")
+        return False
+    return True
+
+
+def deliver_whatsapp_reply(to_number, text_message, idempotency_key):
+    payload = {
+        "from": VONAGE_SANDBOX_NUMBER,
+        "to": to_number,
+        "message_type": "text",
+        "text": text_message,
+        "channel": "whatsapp",
+        "client_ref": idempotency_key
+    }
     
-    response = requests.post(VONAGE_MESSAGES_API_URL, headers=headers, json=payload)
-    if response.status_code == 202:
+    try:
+        response = vonage_dispatcher.send(payload)
+    except DeliveryUnknownError:
+        # Vonage does not dedupe on client_ref, so replaying this could send the reply twice
+        logger.error(f"Delivery of {idempotency_key} to {to_number} is unknown, waiting for its status webhook.")
+        return STATUS_UNKNOWN
+    if response is not None and response.status_code == 202:
         message_uuid = response.json().get("message_uuid")
         logger.info(f"Message accepted by Vonage, UUID: {message_uuid}")
-        table_manager.update_message_count(to_number, count + 1)
-    else:
-        logger.error(f"Failed to send message via Vonage to {to_number}, Status Code: {response.status_code}, Response Body: {response.text}")
+        return STATUS_SENT
+    logger.error(f"Failed to send message via Vonage to {to_number}, Status Code: {getattr(response, 'status_code', None)}, Response Body: {getattr(response, 'text', None)}")
+    if response is not None and response.status_code not in RETRYABLE_STATUS_CODES:
+        # Vonage rejected the message itself, a replay would be rejected again
+        return STATUS_DEAD
+    return STATUS_PENDING
+
+
+def count_replayed_reply(to_number):
+    table_manager.increment_message_count(to_number)
+
+
+# Must outlive the worker, e.g. a file on an Azure Files share mounted into the function app;
+# the instance temp directory is wiped on recycle along with the replies it was keeping
+OUTBOX_DB_PATH = os.getenv('OUTBOX_DB_PATH')
+reply_outbox = Outbox(
+    OUTBOX_DB_PATH,
+    deliver_whatsapp_reply,
+    on_replayed=count_replayed_reply,
+    batch_size=int(os.getenv('OUTBOX_BATCH_SIZE', '50')),
+    drain_interval=float(os.getenv('OUTBOX_DRAIN_INTERVAL', '30')),
+)
 
 
 
@@ -472,6 +840,9 @@ async def query_flowise(question, chat_id, history=None, overrideConfig=None):
 
     logger.info(f"Payload for Flowise: {payload}")
 
+    shadow_task = flowise_shadow.mirror(payload, headers) if flowise_shadow.should_mirror() else None
+    started = time.perf_counter()
+    answer = None
     try:
         response_data = await async_post_with_aiohttp(FLOWISE_API_URL, payload, headers)
         logger.info(f"Response from Flowise: {response_data}")
@@ -482,9 +853,15 @@ async def query_flowise(question, chat_id, history=None, overrideConfig=None):
                 if message['role'] == 'assistant' and 'content' in message and message['content']:
                     for content in message['content']:
                         if 'text' in content and 'value' in content['text']:
-                            return content['text']['value']
+                            answer = content['text']['value']
+                            return answer
 
         return 'Sorry, I could not process your request.'  # Default response if no suitable message is found
     except Exception as e:
         logger.error(f"Error querying Flowise: {e}")
         return "We are currently updating our systems to accommodate all of you, please check in later"
+    finally:
+        usage_tracker.record(chat_id, 'flowise', started, estimate_tokens(question),
+                             estimate_tokens(answer), error=answer is None)
+        if shadow_task is not None:
+            flowise_shadow.pair(shadow_task, (time.perf_counter() - started) * 1000, answer is None)
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+
+from .flightmanager import normalize_question
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class Burst:
+    def __init__(self):
+        self.texts = []
+        self.text_keys = set()
+        self.image_urls = []
+        self.started = time.monotonic()
+        self.last_arrival = self.started
+
+    def add(self, text=None, image_url=None):
+        # Redelivered copies of a message land in the same burst, keep only the first
+        if text and normalize_question(text) not in self.text_keys:
+            self.text_keys.add(normalize_question(text))
+            self.texts.append(text)
+        if image_url:
+            self.image_urls.append(image_url)
+        self.last_arrival = time.monotonic()
+
+    def __len__(self):
+        return len(self.texts) + len(self.image_urls)
+
+
+class BurstManager:
+    def __init__(self, window: float, max_wait: float):
+        self.window = window
+        self.max_wait = max_wait
+        self.bursts = {}
+        logger.info(f"BurstManager initialized with window: {self.window}s, max wait: {self.max_wait}s")
+
+    async def collect(self, sender, text=None, image_url=None):
+        """
+        Add a message to the sender's open burst. The first message of a burst waits
+        until the sender has been quiet for the window (capped at max_wait) and gets
+        the merged burst back; later messages join it and get None.
+        """
+        burst = self.bursts.get(sender)
+        if burst is not None:
+            burst.add(text, image_url)
+            logger.info(f"Merged message into open burst for {sender}, burst size: {len(burst)}")
+            return None
+
+        burst = Burst()
+        burst.add(text, image_url)
+        self.bursts[sender] = burst
+
+        try:
+            while self.window > 0:
+                now = time.monotonic()
+                deadline = min(burst.last_arrival + self.window, burst.started + self.max_wait)
+                if now >= deadline:
+                    break
+                await asyncio.sleep(deadline - now)
+        finally:
+            self.bursts.pop(sender, None)
+
+        if len(burst) > 1:
+            logger.info(f"Closed burst for {sender} with {len(burst.texts)} texts and {len(burst.image_urls)} images")
+        return burst
@@ -1,27 +1,56 @@
-from azure.data.tables import TableServiceClient
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+import json
 import os
 import logging
 import threading
+import time
+from dataclasses import dataclass
+from .storagebackends import create_backend
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Recently completed invoices kept per number, so repeated COMPLETE reports are recognised
+COMPLETED_INVOICES_KEPT = 10
+
+
+@dataclass(frozen=True)
+class QuotaState:
+    message_count: int
+    notification_sent: bool
+
+
+@dataclass(frozen=True)
+class PaymentSession:
+    invoice_id: str
+    state: str
+    updated_at: float
+
+
 class TableStorageManager:
-    def __init__(self, connection_string: str, table_name: str):
+    def __init__(self, connection_string: str, table_name: str, backend=None):
         self.table_name = table_name
-        self.table_service_client = TableServiceClient.from_connection_string(connection_string)
+        self.backend = backend or create_backend(connection_string, table_name)
         self.reset_timers = {}
         logger.info(f"TableStorageManager initialized with table: {self.table_name}")
 
-    def get_table_client(self):
-        return self.table_service_client.get_table_client(table_name=self.table_name)
+    def ensure_table(self):
+        self.backend.ensure_table()
+
+    def get_entity(self, partition_key, row_key):
+        return self.backend.get_entity(partition_key, row_key)
+
+    def upsert_entity(self, entity):
+        self.backend.upsert_entity(entity)
+
+    def upsert_entities(self, entities):
+        self.backend.upsert_entities(entities)
+        logger.info(f"Upserted {len(entities)} entities into {self.table_name}")
 
     def get_message_count(self, phone_number):
-        table_client = self.get_table_client()
         try:
-            entity = table_client.get_entity(row_key=phone_number, partition_key=phone_number)
+            entity = self.backend.get_entity(phone_number, phone_number)
             logger.info(f"Retrieved message count for {phone_number}: {entity['MessageCount']}")
             return entity['MessageCount']
         except ResourceNotFoundError:
@@ -31,47 +60,198 @@ class TableStorageManager:
             logger.error(f"Error retrieving message count for {phone_number}: {e}")
             raise
 
+    def get_quota_state(self, phone_number):
+        # Message count and notification flag in a single round trip
+        try:
+            entity = self.backend.get_entity(phone_number, phone_number)
+            return QuotaState(entity.get('MessageCount', 0), entity.get('NotificationSent', False))
+        except ResourceNotFoundError:
+            logger.info(f"No quota state found for {phone_number}, returning defaults")
+            return QuotaState(0, False)
+        except Exception as e:
+            logger.error(f"Error retrieving quota state for {phone_number}: {e}")
+            raise
+
+    def get_payment_session(self, phone_number):
+        try:
+            entity = self.backend.get_entity(phone_number, phone_number)
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error retrieving payment session for {phone_number}: {e}", exc_info=True)
+            return None
+        if not entity.get('InvoiceId'):
+            return None
+        return PaymentSession(entity['InvoiceId'], entity.get('InvoiceState'), entity.get('InvoiceUpdatedAt', 0.0))
+
+    def set_payment_session(self, phone_number, invoice_id, state):
+        entity = {
+            'PartitionKey': phone_number,
+            'RowKey': phone_number,
+            'InvoiceId': invoice_id,
+            'InvoiceState': state,
+            'InvoiceUpdatedAt': time.time()
+        }
+        try:
+            self.backend.upsert_entity(entity)
+            logger.info(f"Payment session for {phone_number} set to invoice {invoice_id}, state {state}.")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to store payment session for {phone_number}: {e}", exc_info=True)
+            return False
+
+    def claim_payment_session(self, phone_number, ttl, max_attempts=5):
+        """
+        Mark the number as INITIATING an STK push with a conditional write, unless a push
+        younger than ttl seconds is already initiating or pending. Returns True only for
+        the single caller that won the claim.
+        """
+        for _ in range(max_attempts):
+            try:
+                entity, etag = self.backend.get_entity_with_etag(phone_number, phone_number)
+            except ResourceNotFoundError:
+                entity, etag = {}, None
+            except Exception as e:
+                logger.error(f"Error reading payment session for {phone_number}: {e}", exc_info=True)
+                return False
+
+            if entity.get('InvoiceState') in ('INITIATING', 'PENDING') and time.time() - entity.get('InvoiceUpdatedAt', 0.0) < ttl:
+                return False
+
+            claim = {'PartitionKey': phone_number, 'RowKey': phone_number,
+                     'InvoiceState': 'INITIATING', 'InvoiceUpdatedAt': time.time()}
+            try:
+                if etag is None:
+                    self.backend.create_entity(claim)
+                else:
+                    self.backend.merge_entity_if_match(claim, etag)
+                logger.info(f"Claimed payment session for {phone_number}.")
+                return True
+            except (ResourceModifiedError, ResourceExistsError):
+                # Someone wrote the entity in between, look again before giving up
+                continue
+            except Exception as e:
+                logger.error(f"Failed to claim payment session for {phone_number}: {e}", exc_info=True)
+                return False
+        logger.info(f"Payment session for {phone_number} kept changing, not claiming it.")
+        return False
+
+    def complete_payment(self, phone_number, invoice_id, max_attempts=5):
+        """
+        Reset the message count for a completed invoice and record the invoice in the
+        same ETag-conditional write. Returns True if this call applied the payment,
+        False if the invoice had already been applied, or None if it could not be stored.
+        """
+        for _ in range(max_attempts):
+            try:
+                entity, etag = self.backend.get_entity_with_etag(phone_number, phone_number)
+            except ResourceNotFoundError:
+                entity, etag = {}, None
+            except Exception as e:
+                logger.error(f"Error reading payment state for {phone_number}: {e}", exc_info=True)
+                return None
+
+            completed = json.loads(entity.get('CompletedInvoices') or '[]')
+            if invoice_id in completed:
+                return False
+
+            update = {'PartitionKey': phone_number, 'RowKey': phone_number, 'MessageCount': 0,
+                      'CompletedInvoices': json.dumps((completed + [invoice_id])[-COMPLETED_INVOICES_KEPT:])}
+            # Only move the session along if a newer push has not taken it over
+            if entity.get('InvoiceState') != 'INITIATING' and entity.get('InvoiceId') in (None, invoice_id):
+                update.update({'InvoiceId': invoice_id, 'InvoiceState': 'COMPLETE', 'InvoiceUpdatedAt': time.time()})
+            try:
+                if etag is None:
+                    self.backend.create_entity(update)
+                else:
+                    self.backend.merge_entity_if_match(update, etag)
+                logger.info(f"Applied payment of invoice {invoice_id} for {phone_number}, message count reset.")
+                return True
+            except (ResourceModifiedError, ResourceExistsError):
+                continue
+            except Exception as e:
+                logger.error(f"Failed to apply payment of invoice {invoice_id} for {phone_number}: {e}", exc_info=True)
+                return None
+        logger.error(f"Payment state for {phone_number} kept changing, invoice {invoice_id} not applied yet.")
+        return None
+
+    def release_payment_session(self, phone_number):
+        # Lets the next message retry right away after a push that never went out
+        return self.merge_entity(phone_number, {'InvoiceState': 'FAILED', 'InvoiceUpdatedAt': time.time()})
+
     def update_message_count(self, phone_number, count):
-        table_client = self.get_table_client()
         entity = {
             'PartitionKey': phone_number,
             'RowKey': phone_number,
             'MessageCount': count
         }
         try:
-            table_client.upsert_entity(entity=entity)
+            self.backend.upsert_entity(entity)
             logger.info(f"Updated message count for {phone_number}: {count}")
         except Exception as e:
             logger.error(f"Error updating message count for {phone_number}: {e}")
             raise
 
+    def increment_message_count(self, phone_number, max_attempts=10):
+        # Optimistic concurrency, so overlapping replies to one number never lose an increment
+        for _ in range(max_attempts):
+            try:
+                entity, etag = self.backend.get_entity_with_etag(phone_number, phone_number)
+            except ResourceNotFoundError:
+                entity, etag = {}, None
+            count = entity.get('MessageCount', 0) + 1
+            update = {'PartitionKey': phone_number, 'RowKey': phone_number, 'MessageCount': count}
+            try:
+                if etag is None:
+                    self.backend.create_entity(update)
+                else:
+                    self.backend.merge_entity_if_match(update, etag)
+                logger.info(f"Incremented message count for {phone_number}: {count}")
+                return count
+            except (ResourceModifiedError, ResourceExistsError):
+                logger.info(f"Message count for {phone_number} changed concurrently, retrying increment.")
+            except Exception as e:
+                logger.error(f"Error incrementing message count for {phone_number}: {e}")
+                raise
+        logger.error(f"Gave up incrementing message count for {phone_number} after {max_attempts} conflicts.")
+        return None
+
     def reset_message_count(self, phone_number):
-        table_client = self.get_table_client()
-        try:
-            entity = table_client.get_entity(partition_key=phone_number, row_key=phone_number)
-            entity['MessageCount'] = 0
-            table_client.update_entity(entity)
+        if self.merge_entity(phone_number, {'MessageCount': 0}):
             logger.info(f"Message count successfully reset for {phone_number}.")
             return True
+        return False
+
+    def merge_entity(self, phone_number, fields):
+        # A single merge round trip, fails if the entity does not exist yet
+        entity = {'PartitionKey': phone_number, 'RowKey': phone_number, **fields}
+        try:
+            self.backend.merge_entity(entity)
+            return True
         except Exception as e:
-            logger.error(f"Failed to reset message count for {phone_number}: {e}", exc_info=True)
+            logger.error(f"Failed to merge {list(fields)} for {phone_number}: {e}", exc_info=True)
             return False
 
+    def iter_entity_pages(self, modified_since=None, after_partition_key=None, min_message_count=None,
+                          select=None, page_size=1000):
+        """
+        Stream the table one page at a time so callers never hold the whole table in memory.
+        Every entity carries its last modified time in the 'Timestamp' key.
+        """
+        return self.backend.iter_entity_pages(modified_since=modified_since, after_partition_key=after_partition_key,
+                                              min_message_count=min_message_count, select=select, page_size=page_size)
+
     def is_notification_sent(self, phone_number):
-        table_client = self.get_table_client()
         try:
-            entity = table_client.get_entity(partition_key=phone_number, row_key=phone_number)
+            entity = self.backend.get_entity(phone_number, phone_number)
             return entity.get('NotificationSent', False)
         except Exception as e:
             logger.error(f"Error checking notification status for {phone_number}: {e}", exc_info=True)
             return False
 
     def set_notification_sent(self, phone_number, sent=True):
-        table_client = self.get_table_client()
         try:
-            entity = table_client.get_entity(partition_key=phone_number, row_key=phone_number)
-            entity['NotificationSent'] = sent
-            table_client.update_entity(entity)
+            self.backend.merge_entity({'PartitionKey': phone_number, 'RowKey': phone_number, 'NotificationSent': sent})
             logger.info(f"Notification sent status set to {sent} for {phone_number}.")
 
             # Manage the timer for resetting the notification
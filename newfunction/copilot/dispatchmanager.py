@@ -0,0 +1,173 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DeliveryUnknownError(Exception):
+    """The request failed after it may have reached Vonage, so sending it again could duplicate the message."""
+
+
+def request_never_sent(error):
+    # Connect timeouts and refused or unresolvable connections fail before the request goes out
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, letting the balance go negative, and return how many seconds
+        the caller has to wait before its token is actually available.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class VonageDispatcher:
+    def __init__(self, api_url, token_factory, global_rate=20.0, per_number_rate=1.0, per_number_burst=5,
+                 max_retries=4, base_backoff=0.5, max_backoff=30.0, timeout=10, metrics_interval=60):
+        self.api_url = api_url
+        self.token_factory = token_factory
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.per_number_rate = per_number_rate
+        self.per_number_burst = per_number_burst
+        self.number_buckets = {}
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.metrics_interval = metrics_interval
+        self.metrics_logged = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {'queue_depth': 0, 'in_flight': 0, 'sent': 0, 'retried': 0, 'throttled': 0, 'failed': 0}
+        logger.info(f"VonageDispatcher initialized with global rate: {global_rate}/s, per number rate: {per_number_rate}/s")
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    def _number_bucket(self, number):
+        with self.lock:
+            bucket = self.number_buckets.get(number)
+            if bucket is None:
+                # Drop idle buckets now and then so the map does not grow forever
+                if len(self.number_buckets) > 10000:
+                    self.number_buckets = {n: b for n, b in self.number_buckets.items() if not b.is_full()}
+                bucket = self.number_buckets[number] = TokenBucket(self.per_number_rate, self.per_number_burst)
+            return bucket
+
+    def _backoff(self, attempt, response):
+        # Full jitter, but never retry sooner than Vonage asked us to
+        backoff = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                backoff = max(backoff, min(retry_after, self.max_backoff))
+        return backoff
+
+    def _log_metrics(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.metrics_logged < self.metrics_interval:
+                return
+            self.metrics_logged = now
+            snapshot = dict(self.counters)
+        logger.info(f"Vonage dispatcher metrics: {snapshot}")
+
+    def send(self, payload):
+        """
+        Post a message to the Vonage Messages API within the global and per number
+        rate limits, retrying throttled and server errors. Returns the last response,
+        or None if Vonage could not be reached at all. Raises DeliveryUnknownError when
+        the request failed after it may have been sent, e.g. on a read timeout.
+        """
+        response = None
+        self._count('queue_depth')
+        try:
+            for attempt in range(self.max_retries + 1):
+                delay = max(self.global_bucket.reserve(), self._number_bucket(payload.get('to')).reserve())
+                if delay:
+                    time.sleep(delay)
+
+                headers = {
+                    'Content-Type': 'application/json',
+                    'Authorization': f'Bearer {self.token_factory()}',
+                }
+                self._count('in_flight')
+                try:
+                    response = requests.post(self.api_url, headers=headers, json=payload, timeout=self.timeout)
+                except requests.RequestException as e:
+                    if not request_never_sent(e):
+                        logger.error(f"Vonage request for {payload.get('to')} failed after it may have been sent: {e}")
+                        self._count('failed')
+                        raise DeliveryUnknownError(str(e)) from e
+                    # The request never reached Vonage, so it is safe to send it again
+                    logger.error(f"Could not reach Vonage for {payload.get('to')}: {e}")
+                    response = None
+                finally:
+                    self._count('in_flight', -1)
+
+                if response is not None and response.status_code not in RETRYABLE_STATUS_CODES:
+                    self._count('sent' if response.status_code == 202 else 'failed')
+                    return response
+
+                if attempt == self.max_retries:
+                    break
+
+                if response is not None and response.status_code == 429:
+                    self._count('throttled')
+                self._count('retried')
+                backoff = self._backoff(attempt, response)
+                logger.warning(f"Retrying Vonage message to {payload.get('to')} in {backoff:.2f}s, "
+                               f"status: {response.status_code if response is not None else 'no response'}")
+                time.sleep(backoff)
+
+            self._count('failed')
+            return response
+        finally:
+            self._count('queue_depth', -1)
+            self._log_metrics()
@@ -0,0 +1,82 @@
+import argparse
+import csv
+import gzip
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from .jobstate import JOB_STATE_TABLE, load_job_state, save_job_state
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Must point at storage that outlives the worker and that the reporting job can read,
+# e.g. an Azure Files share mounted into the function app
+COUNTER_EXPORT_DIR = os.getenv('COUNTER_EXPORT_DIR')
+COUNTER_EXPORT_PAGE_SIZE = int(os.getenv('COUNTER_EXPORT_PAGE_SIZE', '1000'))
+# Pause between pages so the export never competes with live traffic for the table
+COUNTER_EXPORT_PAGE_PAUSE = float(os.getenv('COUNTER_EXPORT_PAGE_PAUSE', '0.1'))
+# Margin for clock skew between this worker and the storage service timestamps
+COUNTER_EXPORT_WATERMARK_SKEW = int(os.getenv('COUNTER_EXPORT_WATERMARK_SKEW', '60'))
+
+EXPORT_JOB_NAME = 'counter-export'
+EXPORT_FIELDS = ['PartitionKey', 'RowKey', 'MessageCount', 'NotificationSent', 'Timestamp']
+
+
+def export_counters(table_manager, state_manager, export_dir=None, full=False,
+                    page_size=COUNTER_EXPORT_PAGE_SIZE, page_pause=COUNTER_EXPORT_PAGE_PAUSE):
+    """
+    Stream every counter entity (or only those changed since the last export) into a
+    gzip compressed CSV file, one page at a time. Returns the file path and row count.
+    """
+    export_dir = export_dir or COUNTER_EXPORT_DIR
+    if not export_dir:
+        raise ValueError("COUNTER_EXPORT_DIR is not set, point it at persistent storage to export counters")
+
+    state = {} if full else load_job_state(state_manager, EXPORT_JOB_NAME)
+    since = datetime.fromisoformat(state['watermark']) if state.get('watermark') else None
+
+    # Anything written after the scan starts is picked up by the next export
+    started = datetime.now(timezone.utc)
+    watermark = started - timedelta(seconds=COUNTER_EXPORT_WATERMARK_SKEW)
+
+    os.makedirs(export_dir, exist_ok=True)
+    path = os.path.join(export_dir, f"message-counter-{started:%Y%m%dT%H%M%SZ}.csv.gz")
+    logger.info(f"Exporting counters to {path}, changed since: {since or 'the beginning'}")
+
+    rows = 0
+    with gzip.open(f"{path}.part", 'wt', newline='', encoding='utf-8') as export_file:
+        writer = csv.DictWriter(export_file, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for page in table_manager.iter_entity_pages(modified_since=since, select=EXPORT_FIELDS, page_size=page_size):
+            for entity in page:
+                timestamp = entity.get('Timestamp')
+                entity['Timestamp'] = timestamp.isoformat() if timestamp else ''
+                writer.writerow(entity)
+            rows += len(page)
+            if page_pause:
+                time.sleep(page_pause)
+    os.replace(f"{path}.part", path)
+
+    elapsed = (datetime.now(timezone.utc) - started).total_seconds()
+    logger.info(f"Exported {rows} counter entities to {path} in {elapsed:.1f}s")
+
+    save_job_state(state_manager, EXPORT_JOB_NAME, {'watermark': watermark.isoformat(), 'last_file': path, 'rows': rows})
+    return path, rows
+
+
+if __name__ == '__main__':
+    from .countermanager import TableStorageManager
+
+    parser = argparse.ArgumentParser(description="Export the MessageCounter table to a compressed CSV file.")
+    parser.add_argument('--out', default=COUNTER_EXPORT_DIR, required=not COUNTER_EXPORT_DIR,
+                        help="Directory to write the export into, defaults to COUNTER_EXPORT_DIR.")
+    parser.add_argument('--full', action='store_true', help="Ignore the watermark and export every entity.")
+    parser.add_argument('--page-size', type=int, default=COUNTER_EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+    manager = TableStorageManager(connection_string, "MessageCounter")
+    state_manager = TableStorageManager(connection_string, JOB_STATE_TABLE)
+    export_counters(manager, state_manager, args.out, full=args.full, page_size=args.page_size)
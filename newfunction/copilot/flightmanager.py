@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import time
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question):
+    return ' '.join(question.casefold().split())
+
+
+class SingleFlight:
+    def __init__(self, reply_window: float):
+        self.reply_window = reply_window
+        self.in_flight = {}
+        self.recent = {}
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, (arrived, _) in self.recent.items() if now - arrived > self.reply_window]:
+            del self.recent[key]
+
+    async def do(self, key, coroutine_factory):
+        """
+        Run coroutine_factory() once per key. Callers that arrive while it is running
+        wait for the same result, as do callers that arrive within reply_window seconds
+        of the leader, measured from the leader's arrival rather than its reply, so a
+        question legitimately asked again later is still answered.
+        Returns (result, leader); only the leader should reply.
+        """
+        self._prune()
+        if key in self.recent:
+            logger.info(f"Request {key} arrived moments after an identical one, suppressing repeat reply.")
+            return self.recent[key][1], False
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            logger.info(f"Request {key} already in flight, waiting for its result.")
+            return await asyncio.shield(future), False
+
+        arrived = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await coroutine_factory()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+        future.set_result(result)
+        self.recent[key] = (arrived, result)
+        return result, True
@@ -0,0 +1,33 @@
+import json
+import logging
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Watermarks and checkpoints of the background jobs live in Table Storage, one row per
+# job, so they survive worker recycles and are shared by every instance
+JOB_STATE_TABLE = 'JobState'
+JOB_STATE_PARTITION = 'jobs'
+
+
+def load_job_state(state_manager, job_name):
+    try:
+        entity = state_manager.get_entity(JOB_STATE_PARTITION, job_name)
+        return json.loads(entity.get('State') or '{}')
+    except ResourceNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Failed to read state for job {job_name}, starting fresh: {e}")
+        return {}
+
+
+def save_job_state(state_manager, job_name, state):
+    entity = {'PartitionKey': JOB_STATE_PARTITION, 'RowKey': job_name, 'State': json.dumps(state)}
+    try:
+        state_manager.upsert_entity(entity)
+    except ResourceNotFoundError:
+        # First run against this storage account, the table does not exist yet
+        state_manager.ensure_table()
+        state_manager.upsert_entity(entity)
@@ -0,0 +1,98 @@
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library parser
+    orjson = None
+
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+class InvalidPayloadError(ValueError):
+    pass
+
+
+WEBHOOK_MESSAGE = 'message'
+WEBHOOK_STATUS = 'status'
+WEBHOOK_OTHER = 'other'
+
+
+def classify_webhook(data):
+    """
+    Cheaply tell user messages apart from status callbacks and other webhooks by
+    looking at a couple of fields. Anything that is not clearly a status or other
+    webhook is treated as a message, so it still goes through full validation.
+    """
+    if not isinstance(data, dict) or data.get('message_type') is not None:
+        return WEBHOOK_MESSAGE
+    if data.get('status') is not None:
+        return WEBHOOK_STATUS
+    return WEBHOOK_OTHER
+
+
+@dataclass(frozen=True, slots=True)
+class ImageContent:
+    url: str
+    caption: Optional[str] = None
+
+
+@dataclass(frozen=True, slots=True)
+class InboundMessage:
+    message_uuid: Optional[str]
+    sender: Optional[str]
+    to: Optional[str]
+    message_type: Optional[str]
+    channel: Optional[str] = None
+    timestamp: Optional[str] = None
+    text: Optional[str] = None
+    image: Optional[ImageContent] = None
+
+    @classmethod
+    def from_dict(cls, data) -> 'InboundMessage':
+        """
+        Build a message from a Vonage inbound webhook body, failing fast on anything
+        the conversation pipeline would otherwise trip over later.
+        """
+        if not isinstance(data, dict):
+            raise InvalidPayloadError("Payload must be a JSON object")
+
+        message_type = data.get('message_type')
+        if message_type is not None:
+            if not isinstance(data.get('message_uuid'), str) or not isinstance(data.get('from'), str):
+                raise InvalidPayloadError("Message is missing message_uuid or from")
+
+        text = None
+        image = None
+        if message_type == 'text':
+            text = data.get('text')
+            if not isinstance(text, str):
+                raise InvalidPayloadError("Text message has no text")
+        elif message_type == 'image':
+            image_info = data.get('image')
+            if not isinstance(image_info, dict) or not isinstance(image_info.get('url'), str):
+                raise InvalidPayloadError("Image message has no image url")
+            caption = image_info.get('caption')
+            image = ImageContent(url=image_info['url'], caption=caption if isinstance(caption, str) else None)
+
+        return cls(
+            message_uuid=data.get('message_uuid'),
+            sender=data.get('from'),
+            to=data.get('to'),
+            message_type=message_type,
+            channel=data.get('channel'),
+            timestamp=data.get('timestamp'),
+            text=text,
+            image=image,
+        )
@@ -0,0 +1,175 @@
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_DEAD = 'dead'
+# Delivery failed after the provider may have accepted the message; never replayed
+# automatically, only settled by a status webhook that reports it by idempotency key
+STATUS_UNKNOWN = 'unknown'
+
+
+class Outbox:
+    def __init__(self, db_path, deliver, on_replayed=None, batch_size=50, drain_interval=30,
+                 max_attempts=20, stale_after=300, retention=7 * 24 * 3600):
+        """
+        deliver(to_number, text, idempotency_key) sends one message and returns the status
+        it moves to: STATUS_SENT once the provider accepted it, STATUS_PENDING to retry
+        later, STATUS_DEAD for a permanent rejection, or STATUS_UNKNOWN when the provider
+        may have accepted it. on_replayed(to_number) runs when a message that did not go
+        through on its first attempt is later delivered or confirmed.
+        """
+        self.db_path = db_path
+        self.deliver = deliver
+        self.on_replayed = on_replayed
+        self.batch_size = batch_size
+        self.drain_interval = drain_interval
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.retention = retention
+        self.lock = threading.Lock()
+        # Opened on first use, so importing the app never touches the disk
+        self.connection = None
+        self.drainer = None
+
+    def _connect(self):
+        if not self.db_path:
+            raise ValueError("Outbox database path is not set, point OUTBOX_DB_PATH at persistent storage")
+        connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "idempotency_key TEXT PRIMARY KEY, to_number TEXT NOT NULL, text TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, updated_at)")
+        logger.info(f"Outbox initialized at {self.db_path}")
+        return connection
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            if self.connection is None:
+                self.connection = self._connect()
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def send(self, to_number, text, idempotency_key=None):
+        """
+        Record the message, then try to deliver it right away. A message that cannot
+        be delivered now stays in the outbox for the drainer to replay.
+        """
+        self.start()
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+        now = time.time()
+        inserted = self._execute(
+            "INSERT INTO outbox (idempotency_key, to_number, text, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING RETURNING idempotency_key",
+            (idempotency_key, to_number, text, STATUS_SENDING, now, now))
+        if not inserted:
+            logger.info(f"Outbox message {idempotency_key} already recorded, not sending it again.")
+            return False
+        return self._attempt(idempotency_key, to_number, text) == STATUS_SENT
+
+    def _attempt(self, idempotency_key, to_number, text):
+        try:
+            status = self.deliver(to_number, text, idempotency_key)
+        except Exception as e:
+            logger.error(f"Outbox delivery of {idempotency_key} raised: {e}", exc_info=True)
+            status = STATUS_PENDING
+
+        if status == STATUS_PENDING:
+            self._execute(
+                "UPDATE outbox SET status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, "
+                "attempts = attempts + 1, updated_at = ? WHERE idempotency_key = ?",
+                (self.max_attempts, STATUS_DEAD, STATUS_PENDING, time.time(), idempotency_key))
+        else:
+            self._execute("UPDATE outbox SET status = ?, attempts = attempts + 1, updated_at = ? WHERE idempotency_key = ?",
+                          (status, time.time(), idempotency_key))
+        if status == STATUS_DEAD:
+            logger.error(f"Outbox message {idempotency_key} to {to_number} was rejected, not retrying it.")
+        return status
+
+    def confirm(self, idempotency_key):
+        """
+        Mark a message as sent when a provider status webhook reports it, settling
+        messages whose first delivery attempt was in doubt or failed.
+        """
+        confirmed = self._execute(
+            "UPDATE outbox SET status = ?, updated_at = ? WHERE idempotency_key = ? AND status IN (?, ?) "
+            "RETURNING to_number",
+            (STATUS_SENT, time.time(), idempotency_key, STATUS_UNKNOWN, STATUS_PENDING))
+        if not confirmed:
+            return False
+        logger.info(f"Outbox message {idempotency_key} confirmed by status webhook.")
+        if self.on_replayed:
+            self.on_replayed(confirmed[0][0])
+        return True
+
+    def _park_stale(self):
+        # Messages stuck in 'sending' belong to a worker that died or stalled mid delivery.
+        # Vonage may already have accepted them, so they wait for a status webhook instead.
+        parked = self._execute(
+            "UPDATE outbox SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ? RETURNING idempotency_key",
+            (STATUS_UNKNOWN, time.time(), STATUS_SENDING, time.time() - self.stale_after))
+        if parked:
+            logger.warning(f"Outbox parked {len(parked)} messages stuck in delivery as unknown")
+
+    def _claim_batch(self):
+        now = time.time()
+        return self._execute(
+            "UPDATE outbox SET status = ?, updated_at = ? WHERE idempotency_key IN ("
+            "SELECT idempotency_key FROM outbox WHERE status = ? "
+            "ORDER BY created_at LIMIT ?) RETURNING idempotency_key, to_number, text",
+            (STATUS_SENDING, now, STATUS_PENDING, self.batch_size))
+
+    def drain(self):
+        delivered = 0
+        failed = 0
+        self._park_stale()
+        while True:
+            batch = self._claim_batch()
+            if not batch:
+                break
+            batch_failed = 0
+            for idempotency_key, to_number, text in batch:
+                if self._attempt(idempotency_key, to_number, text) == STATUS_SENT:
+                    delivered += 1
+                    if self.on_replayed:
+                        self.on_replayed(to_number)
+                else:
+                    batch_failed += 1
+            failed += batch_failed
+            # The provider is still down, wait for the next drain instead of spinning
+            if batch_failed == len(batch):
+                break
+
+        self._execute("DELETE FROM outbox WHERE status = ? AND updated_at < ?", (STATUS_SENT, time.time() - self.retention))
+        if delivered or failed:
+            logger.info(f"Outbox drain delivered {delivered} messages, {failed} still pending")
+        return delivered
+
+    def pending_count(self):
+        return self._execute("SELECT COUNT(*) FROM outbox WHERE status IN (?, ?, ?)",
+                             (STATUS_PENDING, STATUS_SENDING, STATUS_UNKNOWN))[0][0]
+
+    def start(self):
+        with self.lock:
+            if self.drainer is not None:
+                return
+            self.drainer = threading.Thread(target=self._run, name='outbox-drainer', daemon=True)
+        self.drainer.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.drain_interval)
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"Outbox drain failed: {e}", exc_info=True)
@@ -0,0 +1,120 @@
+import cProfile
+import hashlib
+import hmac
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Fraction of requests to profile, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Profile every request until this unix timestamp, for a fixed capture window
+PROFILE_UNTIL = float(os.getenv('PROFILE_UNTIL', '0'))
+# Secret used to sign the X-Profile-Request header, the header is ignored without it
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'profiles'))
+
+PROFILE_HEADER = 'X-Profile-Request'
+
+# Only one request is profiled at a time
+profile_lock = threading.Lock()
+# Profilers of worker thread calls made while a request is being profiled, or None
+thread_profilers = None
+thread_profilers_lock = threading.Lock()
+
+
+def sign_profile_request(expires_at, secret=PROFILE_SECRET):
+    signature = hmac.new(secret.encode('utf-8'), str(int(expires_at)).encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{int(expires_at)}:{signature}"
+
+
+def is_signed_profile_request(header_value):
+    """
+    The header carries '<expiry unix time>:<hex hmac-sha256 of the expiry>' so a
+    leaked header stops working once it expires.
+    """
+    if not PROFILE_SECRET or not header_value or ':' not in header_value:
+        return False
+    expires_at, _, signature = header_value.partition(':')
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(sign_profile_request(expires_at), header_value)
+
+
+def should_profile(headers=None):
+    if PROFILE_UNTIL and time.time() < PROFILE_UNTIL:
+        return True
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return True
+    return bool(headers) and is_signed_profile_request(headers.get(PROFILE_HEADER))
+
+
+@contextmanager
+def maybe_profile(name, enabled):
+    """
+    Profile the wrapped block with cProfile and dump pstats to PROFILE_DIR. Skips
+    silently when profiling is off or another request is already being profiled.
+    Since this wraps a coroutine, the profile also sees other requests running on
+    the event loop in the meantime. cProfile only follows the thread that enabled it,
+    so work handed to other threads is included by running it through profile_call.
+    """
+    global thread_profilers
+    if not enabled or not profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    with thread_profilers_lock:
+        thread_profilers = []
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with thread_profilers_lock:
+            finished, thread_profilers = thread_profilers, None
+        try:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats = pstats.Stats(profiler)
+            for thread_profiler in finished:
+                stats.add(thread_profiler)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}-{int(time.time() * 1000)}-{os.getpid()}.pstats")
+            stats.dump_stats(path)
+            logger.info(f"Wrote profile of {name} ({elapsed_ms:.0f}ms) to {path}")
+        except OSError as e:
+            logger.error(f"Failed to write profile of {name}: {e}")
+        finally:
+            profile_lock.release()
+
+
+def profile_call(function, *args):
+    """
+    Run function(*args) in the current worker thread, profiling it into the active
+    request profile if there is one. Wrap the callables given to asyncio.to_thread
+    or an executor with it.
+    """
+    if thread_profilers is None:
+        return function(*args)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler already owns this interpreter, run unprofiled
+        return function(*args)
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+        with thread_profilers_lock:
+            if thread_profilers is not None:
+                thread_profilers.append(profiler)
@@ -0,0 +1,71 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from .jobstate import load_job_state, save_job_state
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+QUOTA_RESET_ENABLED = os.getenv('QUOTA_RESET_ENABLED', 'false').lower() == 'true'
+# Bounded parallelism keeps the reset from starving live counter reads and writes
+QUOTA_RESET_CONCURRENCY = int(os.getenv('QUOTA_RESET_CONCURRENCY', '8'))
+QUOTA_RESET_PAGE_SIZE = int(os.getenv('QUOTA_RESET_PAGE_SIZE', '500'))
+# Upper bound on rows per second, 0 disables the cap
+QUOTA_RESET_MAX_RATE = float(os.getenv('QUOTA_RESET_MAX_RATE', '0'))
+
+RESET_JOB_NAME = 'quota-reset'
+RESET_FIELDS = {'MessageCount': 0, 'NotificationSent': False}
+
+
+def reset_quotas(table_manager, state_manager, concurrency=QUOTA_RESET_CONCURRENCY, page_size=QUOTA_RESET_PAGE_SIZE,
+                 max_rate=QUOTA_RESET_MAX_RATE):
+    """
+    Reset the message count of every user that has used any of their allowance.
+    Progress is checkpointed after each page, so a run that dies half way resumes
+    from the last finished page instead of starting over.
+    """
+    state = load_job_state(state_manager, RESET_JOB_NAME)
+    checkpoint = state.get('checkpoint') if state.get('in_progress') else None
+    if checkpoint:
+        logger.info(f"Resuming quota reset after {checkpoint}")
+    else:
+        state = {'in_progress': True, 'started_at': datetime.now(timezone.utc).isoformat(), 'rows': 0, 'failed': 0}
+
+    started = time.monotonic()
+    rows = 0
+    failed = 0
+
+    def reset_one(entity):
+        return table_manager.merge_entity(entity['PartitionKey'], RESET_FIELDS)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in table_manager.iter_entity_pages(after_partition_key=checkpoint, min_message_count=1,
+                                                    select=['PartitionKey', 'RowKey'], page_size=page_size):
+            if not page:
+                continue
+
+            results = list(executor.map(reset_one, page))
+            rows += results.count(True)
+            failed += results.count(False)
+
+            # Every entity up to the end of this page has been attempted
+            state['checkpoint'] = page[-1]['PartitionKey']
+            state['rows'] += results.count(True)
+            state['failed'] += results.count(False)
+            save_job_state(state_manager, RESET_JOB_NAME, state)
+
+            elapsed = time.monotonic() - started
+            logger.info(f"Quota reset progress: {rows} rows, {failed} failed, {rows / max(elapsed, 1e-6):.0f} rows/s")
+
+            if max_rate and rows / max(elapsed, 1e-6) > max_rate:
+                time.sleep(rows / max_rate - elapsed)
+
+    elapsed = time.monotonic() - started
+    state.update({'in_progress': False, 'checkpoint': None, 'completed_at': datetime.now(timezone.utc).isoformat()})
+    save_job_state(state_manager, RESET_JOB_NAME, state)
+    logger.info(f"Quota reset finished: {rows} rows reset, {failed} failed in {elapsed:.1f}s "
+                f"({rows / max(elapsed, 1e-6):.0f} rows/s)")
+    return {'rows': rows, 'failed': failed, 'seconds': elapsed}
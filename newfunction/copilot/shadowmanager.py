@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import deque
+
+import aiohttp
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+class ShadowTraffic:
+    def __init__(self, shadow_url, sample_rate: float, report_every: int = 50, max_samples: int = 1000, timeout: float = 60):
+        self.shadow_url = shadow_url
+        self.sample_rate = sample_rate
+        self.report_every = report_every
+        self.timeout = timeout
+        # (primary ms, primary error, shadow ms, shadow error) for the most recent pairs
+        self.samples = deque(maxlen=max_samples)
+        self.pairs = 0
+        self.tasks = set()
+
+    def should_mirror(self):
+        return bool(self.shadow_url) and random.random() < self.sample_rate
+
+    def mirror(self, payload, headers):
+        """
+        Send a copy of the request to the candidate endpoint in the background. The
+        response is discarded; only its latency and whether it failed are kept.
+        """
+        # A separate chat id keeps the candidate from writing into the user's real conversation memory
+        shadow_payload = {**payload, "chatId": f"shadow-{payload.get('chatId')}"}
+        task = asyncio.create_task(self._post(shadow_payload, headers))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _post(self, payload, headers):
+        started = time.perf_counter()
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                async with session.post(self.shadow_url, json=payload, headers=headers) as response:
+                    response.raise_for_status()
+                    await response.read()
+            return (time.perf_counter() - started) * 1000, False
+        except Exception as e:
+            logger.info(f"Shadow Flowise request failed: {e}")
+            return (time.perf_counter() - started) * 1000, True
+
+    def pair(self, shadow_task, primary_ms, primary_error):
+        def record(task):
+            if task.cancelled():
+                return
+            shadow_ms, shadow_error = task.result()
+            self.samples.append((primary_ms, primary_error, shadow_ms, shadow_error))
+            self.pairs += 1
+            if self.pairs % self.report_every == 0:
+                logger.info(f"Flowise shadow comparison: {self.summary()}")
+
+        shadow_task.add_done_callback(record)
+
+    def summary(self):
+        samples = list(self.samples)
+        if not samples:
+            return {}
+        primary_ms = [s[0] for s in samples if not s[1]]
+        shadow_ms = [s[2] for s in samples if not s[3]]
+        both_ok = [s[2] - s[0] for s in samples if not s[1] and not s[3]]
+        return {
+            'pairs': len(samples),
+            'primary_p50_ms': percentile(primary_ms, 50),
+            'primary_p95_ms': percentile(primary_ms, 95),
+            'primary_error_rate': sum(s[1] for s in samples) / len(samples),
+            'shadow_p50_ms': percentile(shadow_ms, 50),
+            'shadow_p95_ms': percentile(shadow_ms, 95),
+            'shadow_error_rate': sum(s[3] for s in samples) / len(samples),
+            'median_delta_ms': statistics.median(both_ok) if both_ok else None,
+        }
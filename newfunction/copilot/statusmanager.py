@@ -0,0 +1,45 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class StatusRecorder:
+    def __init__(self, flush_interval: float = 60, flush_size: int = 500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.counts = Counter()
+        self.totals = Counter()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, data):
+        """
+        Count a Vonage message status callback. Counts are only logged once per
+        flush interval or flush size, never per callback.
+        """
+        status = data.get('status') or 'unknown'
+        if status in ('failed', 'rejected'):
+            logger.warning(f"Message {data.get('message_uuid')} to {data.get('to')} {status}: {data.get('error')}")
+
+        with self.lock:
+            self.counts[status] += 1
+            self.pending += 1
+            due = self.pending >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = dict(self.counts)
+            self.totals.update(self.counts)
+            totals = dict(self.totals)
+            self.counts.clear()
+            self.pending = 0
+            self.last_flush = time.monotonic()
+        if batch:
+            logger.info(f"Message status counts since last flush: {batch}, totals: {totals}")
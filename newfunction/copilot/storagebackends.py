@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.data.tables import TableServiceClient, UpdateMode
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# 'azure' talks to Azure Table Storage, 'sqlite' keeps the tables in a local file
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'azure')
+# Required with the sqlite backend; counters and payment sessions must survive a restart
+SQLITE_STORAGE_PATH = os.getenv('SQLITE_STORAGE_PATH')
+
+# Entity group transactions only span one partition and at most 100 operations
+MAX_BATCH_SIZE = 100
+
+
+class AzureTableBackend:
+    def __init__(self, connection_string: str, table_name: str):
+        self.table_name = table_name
+        self.table_service_client = TableServiceClient.from_connection_string(connection_string)
+
+    def get_table_client(self):
+        return self.table_service_client.get_table_client(table_name=self.table_name)
+
+    def ensure_table(self):
+        self.table_service_client.create_table_if_not_exists(table_name=self.table_name)
+
+    def get_entity(self, partition_key, row_key):
+        return self.get_table_client().get_entity(partition_key=partition_key, row_key=row_key)
+
+    def get_entity_with_etag(self, partition_key, row_key):
+        entity = self.get_table_client().get_entity(partition_key=partition_key, row_key=row_key)
+        return entity, entity.metadata['etag']
+
+    def create_entity(self, entity):
+        self.get_table_client().create_entity(entity=entity)
+
+    def upsert_entity(self, entity):
+        self.get_table_client().upsert_entity(entity=entity, mode=UpdateMode.MERGE)
+
+    def merge_entity(self, entity):
+        self.get_table_client().update_entity(entity, mode=UpdateMode.MERGE)
+
+    def merge_entity_if_match(self, entity, etag):
+        # Raises ResourceModifiedError if anyone wrote the entity since etag was read
+        self.get_table_client().update_entity(entity, mode=UpdateMode.MERGE, etag=etag,
+                                              match_condition=MatchConditions.IfNotModified)
+
+    def upsert_entities(self, entities):
+        table_client = self.get_table_client()
+        partitions = {}
+        for entity in entities:
+            partitions.setdefault(entity['PartitionKey'], []).append(entity)
+        for partition_entities in partitions.values():
+            for start in range(0, len(partition_entities), MAX_BATCH_SIZE):
+                table_client.submit_transaction(
+                    [('upsert', entity) for entity in partition_entities[start:start + MAX_BATCH_SIZE]])
+
+    def iter_entity_pages(self, modified_since=None, after_partition_key=None, min_message_count=None,
+                          select=None, page_size=1000):
+        filters = []
+        parameters = {}
+        if modified_since is not None:
+            filters.append("Timestamp gt @since")
+            parameters['since'] = modified_since
+        if after_partition_key is not None:
+            filters.append("PartitionKey gt @after")
+            parameters['after'] = after_partition_key
+        if min_message_count is not None:
+            filters.append("MessageCount ge @min_count")
+            parameters['min_count'] = min_message_count
+
+        table_client = self.get_table_client()
+        if filters:
+            entities = table_client.query_entities(
+                query_filter=" and ".join(filters),
+                parameters=parameters,
+                select=select,
+                results_per_page=page_size)
+        else:
+            entities = table_client.list_entities(select=select, results_per_page=page_size)
+
+        for page in entities.by_page():
+            rows = []
+            for entity in page:
+                row = dict(entity)
+                row['Timestamp'] = entity.metadata.get('timestamp')
+                rows.append(row)
+            yield rows
+
+
+class SQLiteTableBackend:
+    def __init__(self, db_path: str, table_name: str):
+        """
+        Embedded stand-in for Azure Table Storage with the same merge semantics.
+        Entity properties live in a JSON column; point lookups use the primary key,
+        and Timestamp and MessageCount scans have their own indexes.
+        """
+        if not re.fullmatch(r'[A-Za-z][A-Za-z0-9]{2,62}', table_name):
+            raise ValueError(f"Invalid table name: {table_name}")
+        self.table_name = table_name
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_table()
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def ensure_table(self):
+        with self.lock:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.table_name}" ('
+                'PartitionKey TEXT NOT NULL, RowKey TEXT NOT NULL, Properties TEXT NOT NULL, Timestamp TEXT NOT NULL, '
+                'PRIMARY KEY (PartitionKey, RowKey)) WITHOUT ROWID')
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self.table_name}_timestamp" ON "{self.table_name}" (Timestamp)')
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self.table_name}_message_count" '
+                f'ON "{self.table_name}" (json_extract(Properties, \'$.MessageCount\'))')
+
+    @staticmethod
+    def _split(entity):
+        properties = {key: value for key, value in entity.items() if key not in ('PartitionKey', 'RowKey', 'Timestamp')}
+        return entity['PartitionKey'], entity['RowKey'], json.dumps(properties)
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def get_entity(self, partition_key, row_key):
+        rows = self._execute(
+            f'SELECT Properties FROM "{self.table_name}" WHERE PartitionKey = ? AND RowKey = ?',
+            (partition_key, row_key))
+        if not rows:
+            raise ResourceNotFoundError(f"Entity {partition_key}/{row_key} not found in {self.table_name}")
+        return {'PartitionKey': partition_key, 'RowKey': row_key, **json.loads(rows[0][0])}
+
+    def get_entity_with_etag(self, partition_key, row_key):
+        rows = self._execute(
+            f'SELECT Properties, Timestamp FROM "{self.table_name}" WHERE PartitionKey = ? AND RowKey = ?',
+            (partition_key, row_key))
+        if not rows:
+            raise ResourceNotFoundError(f"Entity {partition_key}/{row_key} not found in {self.table_name}")
+        properties, timestamp = rows[0]
+        # The row itself is the version, so even two writes within one clock tick are told apart
+        return {'PartitionKey': partition_key, 'RowKey': row_key, **json.loads(properties)}, (properties, timestamp)
+
+    def create_entity(self, entity):
+        try:
+            self._execute(
+                f'INSERT INTO "{self.table_name}" (PartitionKey, RowKey, Properties, Timestamp) VALUES (?, ?, ?, ?)',
+                (*self._split(entity), self._now()))
+        except sqlite3.IntegrityError:
+            raise ResourceExistsError(f"Entity {entity['PartitionKey']}/{entity['RowKey']} already exists in {self.table_name}")
+
+    def upsert_entity(self, entity):
+        self._execute(
+            f'INSERT INTO "{self.table_name}" (PartitionKey, RowKey, Properties, Timestamp) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (PartitionKey, RowKey) DO UPDATE SET '
+            'Properties = json_patch(Properties, excluded.Properties), Timestamp = excluded.Timestamp',
+            (*self._split(entity), self._now()))
+
+    def merge_entity(self, entity):
+        partition_key, row_key, properties = self._split(entity)
+        updated = self._execute(
+            f'UPDATE "{self.table_name}" SET Properties = json_patch(Properties, ?), Timestamp = ? '
+            'WHERE PartitionKey = ? AND RowKey = ? RETURNING RowKey',
+            (properties, self._now(), partition_key, row_key))
+        if not updated:
+            raise ResourceNotFoundError(f"Entity {partition_key}/{row_key} not found in {self.table_name}")
+
+    def merge_entity_if_match(self, entity, etag):
+        partition_key, row_key, properties = self._split(entity)
+        updated = self._execute(
+            f'UPDATE "{self.table_name}" SET Properties = json_patch(Properties, ?), Timestamp = ? '
+            'WHERE PartitionKey = ? AND RowKey = ? AND Properties = ? AND Timestamp = ? RETURNING RowKey',
+            (properties, self._now(), partition_key, row_key, *etag))
+        if not updated:
+            # Tell a concurrent write apart from a missing entity, like Table Storage does
+            self.get_entity(partition_key, row_key)
+            raise ResourceModifiedError(f"Entity {partition_key}/{row_key} was modified in {self.table_name}")
+
+    def upsert_entities(self, entities):
+        now = self._now()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    f'INSERT INTO "{self.table_name}" (PartitionKey, RowKey, Properties, Timestamp) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (PartitionKey, RowKey) DO UPDATE SET '
+                    'Properties = json_patch(Properties, excluded.Properties), Timestamp = excluded.Timestamp',
+                    [(*self._split(entity), now) for entity in entities])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def iter_entity_pages(self, modified_since=None, after_partition_key=None, min_message_count=None,
+                          select=None, page_size=1000):
+        filters = []
+        parameters = []
+        if modified_since is not None:
+            filters.append("Timestamp > ?")
+            parameters.append(modified_since.astimezone(timezone.utc).isoformat())
+        if after_partition_key is not None:
+            filters.append("PartitionKey > ?")
+            parameters.append(after_partition_key)
+        if min_message_count is not None:
+            filters.append("json_extract(Properties, '$.MessageCount') >= ?")
+            parameters.append(min_message_count)
+
+        # Keyset pagination keeps every page an index range scan
+        last_key = None
+        while True:
+            page_filters = list(filters)
+            page_parameters = list(parameters)
+            if last_key is not None:
+                page_filters.append("(PartitionKey, RowKey) > (?, ?)")
+                page_parameters.extend(last_key)
+            where = f"WHERE {' AND '.join(page_filters)}" if page_filters else ''
+            rows = self._execute(
+                f'SELECT PartitionKey, RowKey, Properties, Timestamp FROM "{self.table_name}" {where} '
+                'ORDER BY PartitionKey, RowKey LIMIT ?',
+                (*page_parameters, page_size))
+            if not rows:
+                return
+
+            page = []
+            for partition_key, row_key, properties, timestamp in rows:
+                entity = {'PartitionKey': partition_key, 'RowKey': row_key, **json.loads(properties),
+                          'Timestamp': datetime.fromisoformat(timestamp)}
+                if select:
+                    entity = {key: value for key, value in entity.items() if key in select}
+                page.append(entity)
+            yield page
+
+            if len(rows) < page_size:
+                return
+            last_key = rows[-1][:2]
+
+
+def create_backend(connection_string, table_name):
+    if STORAGE_BACKEND == 'sqlite':
+        if not SQLITE_STORAGE_PATH:
+            raise ValueError("STORAGE_BACKEND is sqlite but SQLITE_STORAGE_PATH is not set")
+        logger.info(f"Using SQLite storage at {SQLITE_STORAGE_PATH} for table {table_name}")
+        return SQLiteTableBackend(SQLITE_STORAGE_PATH, table_name)
+    return AzureTableBackend(connection_string, table_name)
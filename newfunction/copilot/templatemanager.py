@@ -0,0 +1,14 @@
+import os
+from string import Template
+
+# Canned replies sent straight to the user without asking the LLM.
+# Any of them can be overridden with a TEMPLATE_<NAME> app setting.
+DEFAULT_TEMPLATES = {
+    'image_received': "I received an image and am analyzing it. Please wait...",
+    'images_received': "I received your $count images and am analyzing them. Please wait...",
+}
+
+
+def render_template(name, **values):
+    text = os.getenv(f"TEMPLATE_{name.upper()}") or DEFAULT_TEMPLATES[name]
+    return Template(text).safe_substitute(values)
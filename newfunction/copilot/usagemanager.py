@@ -0,0 +1,104 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Flowise does not report token usage, so its tokens are estimated from text length
+CHARS_PER_TOKEN = 4
+
+USAGE_FIELDS = ('Calls', 'Errors', 'PromptTokens', 'CompletionTokens', 'Milliseconds')
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1 if text else 0
+
+
+class UsageTracker:
+    def __init__(self, table_manager, flush_interval: float = 60):
+        """
+        Aggregate upstream AI usage per phone number and hour in memory. Every flush
+        upserts this worker's running totals, so a flush that is retried or repeated
+        never double counts. Totals for an hour are the sum over all workers.
+        """
+        self.table_manager = table_manager
+        self.flush_interval = flush_interval
+        instance = os.getenv('WEBSITE_INSTANCE_ID') or socket.gethostname()
+        self.worker_id = f"{instance[:12]}-{os.getpid()}"
+        self.usage = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.table_ready = False
+
+    def record(self, phone_number, kind, started, prompt_tokens=0, completion_tokens=0, error=False):
+        """
+        Record one upstream call; started is the time.perf_counter() value taken
+        right before the call.
+        """
+        if not phone_number or self.table_manager is None:
+            return
+        elapsed_ms = int((time.perf_counter() - started) * 1000)
+        key = (time.strftime('%Y%m%d%H', time.gmtime()), phone_number, kind)
+        with self.lock:
+            totals = self.usage.get(key)
+            if totals is None:
+                totals = self.usage[key] = dict.fromkeys(USAGE_FIELDS, 0)
+            totals['Calls'] += 1
+            totals['Errors'] += int(error)
+            totals['PromptTokens'] += prompt_tokens
+            totals['CompletionTokens'] += completion_tokens
+            totals['Milliseconds'] += elapsed_ms
+            self.dirty.add(key)
+            # The flusher only starts once there is something to flush
+            if self.flusher is None:
+                self.start()
+
+    def flush(self):
+        current_hour = time.strftime('%Y%m%d%H', time.gmtime())
+        with self.lock:
+            keys = list(self.dirty)
+            self.dirty.clear()
+            entities = [
+                {
+                    'PartitionKey': f"{hour}-{self.worker_id}",
+                    'RowKey': f"{phone_number}-{kind}",
+                    'Hour': hour,
+                    'PhoneNumber': phone_number,
+                    'Kind': kind,
+                    **self.usage[(hour, phone_number, kind)],
+                }
+                for hour, phone_number, kind in keys
+            ]
+            # Totals of past hours are final once written
+            for key in [key for key in self.usage if key[0] != current_hour and key not in keys]:
+                del self.usage[key]
+
+        if not entities:
+            return 0
+        try:
+            if not self.table_ready:
+                self.table_manager.ensure_table()
+                self.table_ready = True
+            self.table_manager.upsert_entities(entities)
+        except Exception as e:
+            logger.error(f"Failed to flush usage for {len(entities)} entries, keeping them for the next flush: {e}")
+            with self.lock:
+                self.dirty.update(keys)
+            return 0
+        return len(entities)
+
+    def start(self):
+        if self.flusher is not None or self.table_manager is None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        self.flusher = threading.Thread(target=run, name='usage-flusher', daemon=True)
+        self.flusher.start()
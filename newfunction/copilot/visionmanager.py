@@ -0,0 +1,79 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Rough token estimate, good enough to keep Flowise prompts bounded
+CHARS_PER_TOKEN = 4
+
+
+@dataclass(frozen=True)
+class VisionResult:
+    text: str
+    truncated: bool
+    finish_reason: Optional[str]
+    prompt_tokens: int
+    completion_tokens: int
+
+
+def truncate_to_token_budget(text, token_budget):
+    """
+    Cut text down to roughly token_budget tokens, preferring to end on a sentence
+    and falling back to a word boundary.
+    """
+    max_chars = token_budget * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text, False
+
+    cut = text[:max_chars]
+    sentence_end = max(cut.rfind('. '), cut.rfind('.\n'), cut.rfind('! '), cut.rfind('? '))
+    if sentence_end >= max_chars // 2:
+        return cut[:sentence_end + 1], True
+
+    word_end = cut.rfind(' ')
+    if word_end > 0:
+        cut = cut[:word_end]
+    return cut.rstrip() + '...', True
+
+
+def extract_assistant_text(ai_response):
+    """
+    Pull the assistant text out of a chat completion response, ignoring ids,
+    usage blocks and content filter metadata.
+    """
+    for choice in ai_response.get('choices') or []:
+        message = choice.get('message') or {}
+        content = message.get('content')
+        if isinstance(content, str) and content.strip():
+            return content.strip(), choice.get('finish_reason')
+        if isinstance(content, list):
+            parts = [part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text']
+            text = ' '.join(part for part in parts if part).strip()
+            if text:
+                return text, choice.get('finish_reason')
+    return None, None
+
+
+def extract_vision_result(ai_response, token_budget) -> Optional[VisionResult]:
+    if not ai_response:
+        return None
+
+    text, finish_reason = extract_assistant_text(ai_response)
+    if not text:
+        logger.error(f"No assistant text in Azure AI response: {ai_response}")
+        return None
+
+    text, truncated = truncate_to_token_budget(' '.join(text.split()), token_budget)
+    if truncated:
+        logger.info(f"Image description truncated to {len(text)} characters for a budget of {token_budget} tokens")
+
+    usage = ai_response.get('usage') or {}
+    return VisionResult(
+        text=text,
+        truncated=truncated,
+        finish_reason=finish_reason,
+        prompt_tokens=usage.get('prompt_tokens', 0),
+        completion_tokens=usage.get('completion_tokens', 0),
+    )